@@ -1,98 +1,368 @@
-import wikipedia
+import aiohttp
+import asyncio
 import json
+import msgpack
+import numpy as np
 import os
-from typing import List, Dict
+import re
+import zstandard as zstd
+from typing import List, Dict, Optional
 import logging
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib codec
+    orjson = None
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+USER_AGENT = "wikipedia-rag-assistant/1.0"
+# MediaWiki caps the number of titles a single query may name
+MAX_TITLES_PER_QUERY = 50
+# TextExtracts returns at most 20 intros per query
+MAX_EXTRACTS_PER_QUERY = 20
+# Best-ranked disambiguation options tried, in order, until one is an article
+DISAMBIGUATION_FALLBACKS = 3
+# First wiki link of a list item, e.g. "* [[Python (programming language)|Python]], a ..."
+DISAMBIGUATION_LINK = re.compile(r"\[\[([^\]|#]+)")
+# Links into these namespaces or wikis are not article options
+NON_ARTICLE_PREFIXES = {"", "file", "image", "category", "wikt", "wiktionary", "template", "help", "portal", "wikipedia"}
+
 class WikipediaLoader:
-    def __init__(self, data_path: str = "./data"):
+    def __init__(self, data_path: str = "./data", max_connections: int = 20, embedding_model=None):
         self.data_path = data_path
+        self.max_connections = max_connections
+        # Optional SentenceTransformer used to pick the best disambiguation option
+        self.embedding_model = embedding_model
+        self._session: Optional[aiohttp.ClientSession] = None
         os.makedirs(data_path, exist_ok=True)
     
     def search_and_download(self, topics: List[str], max_articles: int = 5) -> List[Dict]:
         """Search and download Wikipedia articles for given topics"""
-        articles = []
-        
-        for topic in topics:
+        async def run() -> List[Dict]:
             try:
-                logger.info(f"Searching for: {topic}")
-                # Search for articles
-                search_results = wikipedia.search(topic, results=max_articles)
+                return await self.search_and_download_async(topics, max_articles)
+            finally:
+                # The session is bound to this short-lived event loop
+                await self.close()
+        
+        return asyncio.run(run())
+    
+    async def close(self):
+        """Close the pooled HTTP session"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+    
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the pooled HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self._session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENT})
+        return self._session
+    
+    async def search_and_download_async(self, topics: List[str], max_articles: int = 5) -> List[Dict]:
+        """Search and download Wikipedia articles for all topics, batching page lookups"""
+        session = await self._get_session()
+        searches = await asyncio.gather(*(self._search_topic(session, topic, max_articles) for topic in topics))
+        
+        # Coalesce the hits of every topic so each page is resolved and fetched once,
+        # remembering the first topic that found each title
+        topic_by_title = {}
+        for topic, hits in zip(topics, searches):
+            for title in hits:
+                topic_by_title.setdefault(title, topic)
+        
+        pages = await self._resolve_titles(session, list(topic_by_title))
+        await self._resolve_disambiguations(session, pages, topic_by_title)
+        contents = await self._fetch_extracts(session, list(dict.fromkeys(page["title"] for page in pages.values())))
+        
+        articles = []
+        for topic, hits in zip(topics, searches):
+            for title in hits:
+                page = pages.get(title)
+                if page is None or page["title"] not in contents:
+                    continue
                 
-                for title in search_results[:max_articles]:
-                    try:
-                        # Get article content
-                        page = wikipedia.page(title)
-                        
-                        article = {
-                            "title": page.title,
-                            "content": page.content,
-                            "url": page.url,
-                            "summary": page.summary,
-                            "topic": topic
-                        }
-                        
-                        articles.append(article)
-                        logger.info(f"Downloaded: {page.title}")
-                        
-                    except wikipedia.exceptions.DisambiguationError as e:
-                        # Handle disambiguation by taking first option
-                        try:
-                            page = wikipedia.page(e.options[0])
-                            article = {
-                                "title": page.title,
-                                "content": page.content,
-                                "url": page.url,
-                                "summary": page.summary,
-                                "topic": topic
-                            }
-                            articles.append(article)
-                            logger.info(f"Downloaded (disambiguated): {page.title}")
-                        except:
-                            continue
-                            
-                    except Exception as e:
-                        logger.warning(f"Error downloading {title}: {e}")
-                        continue
-                        
-            except Exception as e:
-                logger.error(f"Error searching for {topic}: {e}")
-                continue
+                content = contents[page["title"]]
+                articles.append({
+                    "title": page["title"],
+                    "content": content,
+                    "url": page["url"],
+                    # The plain-text extract puts the lead section before the first "== Heading =="
+                    "summary": content.split("\n\n\n==", 1)[0].strip(),
+                    "topic": topic
+                })
+                if page.get("disambiguated"):
+                    logger.info(f"Downloaded (disambiguated): {page['title']}")
+                else:
+                    logger.info(f"Downloaded: {page['title']}")
         
-        # Save articles
-        self.save_articles(articles)
+        # Save articles without blocking the event loop
+        await asyncio.to_thread(self.save_articles, articles)
         return articles
     
+    async def _query(self, session: aiohttp.ClientSession, **params) -> Dict:
+        """Run a MediaWiki API request (action=query unless another action is given)"""
+        params = {"action": "query", "format": "json", "formatversion": 2, **params}
+        async with session.get(WIKIPEDIA_API_URL, params=params) as response:
+            response.raise_for_status()
+            return await response.json()
+    
+    async def _search_topic(self, session: aiohttp.ClientSession, topic: str, max_articles: int) -> List[str]:
+        """Return the titles of the top search hits for a topic"""
+        try:
+            logger.info(f"Searching for: {topic}")
+            data = await self._query(session, list="search", srsearch=topic, srlimit=max_articles, srprop="")
+            return [hit["title"] for hit in data["query"]["search"]][:max_articles]
+        except Exception as e:
+            logger.error(f"Error searching for {topic}: {e}")
+            return []
+    
+    async def _resolve_titles(self, session: aiohttp.ClientSession, titles: List[str]) -> Dict[str, Dict]:
+        """Map titles to their canonical pages, MAX_TITLES_PER_QUERY titles per request"""
+        batches = [titles[i:i + MAX_TITLES_PER_QUERY] for i in range(0, len(titles), MAX_TITLES_PER_QUERY)]
+        results = await asyncio.gather(
+            *(self._resolve_batch(session, batch) for batch in batches),
+            return_exceptions=True
+        )
+        
+        resolved = {}
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Error resolving {len(batch)} titles: {result}")
+                continue
+            resolved.update(result)
+        return resolved
+    
+    async def _resolve_batch(self, session: aiohttp.ClientSession, titles: List[str]) -> Dict[str, Dict]:
+        """Resolve one batch of titles with a single query, following redirects"""
+        data = await self._query(
+            session,
+            titles="|".join(titles),
+            prop="info|pageprops",
+            inprop="url",
+            ppprop="disambiguation",
+            redirects=1
+        )
+        query = data["query"]
+        aliases = {entry["from"]: entry["to"] for entry in query.get("normalized", []) + query.get("redirects", [])}
+        pages = {page["title"]: page for page in query["pages"] if "title" in page}
+        
+        resolved = {}
+        for title in titles:
+            target, seen = title, set()
+            while target in aliases and target not in seen:
+                seen.add(target)
+                target = aliases[target]
+            
+            page = pages.get(target)
+            if page is None or page.get("missing") or page.get("invalid"):
+                logger.warning(f"Error downloading {title}: page does not exist")
+                continue
+            
+            resolved[title] = {
+                "title": page["title"],
+                "url": page["fullurl"],
+                "disambiguation": "disambiguation" in page.get("pageprops", {})
+            }
+        return resolved
+    
+    async def _resolve_disambiguations(self, session: aiohttp.ClientSession, pages: Dict[str, Dict],
+                                       topic_by_title: Dict[str, str]):
+        """Replace disambiguation pages in place by the option that best matches their topic"""
+        ambiguous = [title for title, page in pages.items() if page["disambiguation"]]
+        if not ambiguous:
+            return
+        
+        options = await asyncio.gather(
+            *(self._disambiguation_options(session, pages[title]["title"]) for title in ambiguous),
+            return_exceptions=True
+        )
+        candidates = {
+            title: choices
+            for title, choices in zip(ambiguous, options)
+            if not isinstance(choices, Exception) and choices
+        }
+        rankings = await asyncio.gather(
+            *(self._rank_options(session, topic_by_title[title], candidates[title]) for title in candidates)
+        )
+        # Resolve a few runners-up too, in case the best option is itself a disambiguation page
+        shortlists = {title: ranked[:DISAMBIGUATION_FALLBACKS] for title, ranked in zip(candidates, rankings)}
+        targets = await self._resolve_titles(
+            session,
+            list(dict.fromkeys(option for shortlist in shortlists.values() for option in shortlist))
+        )
+        
+        for title in ambiguous:
+            page = next(
+                (targets[option] for option in shortlists.get(title, [])
+                 if option in targets and not targets[option]["disambiguation"]),
+                None
+            )
+            if page is None:
+                del pages[title]
+            else:
+                pages[title] = {**page, "disambiguated": True}
+    
+    async def _rank_options(self, session: aiohttp.ClientSession, topic: str, options: List[str]) -> List[str]:
+        """Order disambiguation options by how similar their intros are to the topic, best first"""
+        if self.embedding_model is None or len(options) == 1:
+            return options
+        
+        try:
+            # TextExtracts returns at most 20 intros per query, so fetch them in concurrent batches
+            batches = [options[i:i + MAX_EXTRACTS_PER_QUERY] for i in range(0, len(options), MAX_EXTRACTS_PER_QUERY)]
+            results = await asyncio.gather(
+                *(self._fetch_intros(session, batch) for batch in batches),
+                return_exceptions=True
+            )
+            intros = {}
+            for batch, result in zip(batches, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Error fetching {len(batch)} disambiguation intros for {topic}: {result}")
+                    continue
+                intros.update(result)
+            if not intros:
+                return options
+            
+            titles = list(intros)
+            embeddings = await asyncio.to_thread(
+                self.embedding_model.encode,
+                [topic] + [intros[title] for title in titles],
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            )
+            order = np.argsort(-(embeddings[1:] @ embeddings[0]), kind="stable")
+            # Options without an intro keep their page order after the scored ones
+            return [titles[i] for i in order] + [option for option in options if option not in intros]
+            
+        except Exception as e:
+            logger.warning(f"Error ranking disambiguation options for {topic}: {e}")
+            return options
+    
+    async def _fetch_intros(self, session: aiohttp.ClientSession, titles: List[str]) -> Dict[str, str]:
+        """Fetch the opening of up to MAX_EXTRACTS_PER_QUERY pages with one query"""
+        data = await self._query(
+            session,
+            titles="|".join(titles),
+            prop="extracts",
+            exintro=1,
+            explaintext=1,
+            exchars=512,
+            exlimit=len(titles),
+            redirects=1
+        )
+        return {page["title"]: page["extract"] for page in data["query"]["pages"] if page.get("extract")}
+    
+    async def _disambiguation_options(self, session: aiohttp.ClientSession, title: str) -> List[str]:
+        """Return the articles listed on a disambiguation page, in page order"""
+        # prop=links would return every link sorted by title, so read the list items instead
+        data = await self._query(session, action="parse", page=title, prop="wikitext", redirects=1)
+        options = []
+        for line in data["parse"]["wikitext"].splitlines():
+            if not line.startswith("*"):
+                continue
+            match = DISAMBIGUATION_LINK.search(line)
+            if match is None:
+                continue
+            option = match.group(1).strip().replace("_", " ")
+            if option and (":" not in option or option.split(":", 1)[0].strip().lower() not in NON_ARTICLE_PREFIXES):
+                options.append(option)
+        return list(dict.fromkeys(options))
+    
+    async def _fetch_extracts(self, session: aiohttp.ClientSession, titles: List[str]) -> Dict[str, str]:
+        """Fetch the plain-text content of each page concurrently"""
+        # TextExtracts only returns one full-length extract per request, so these
+        # cannot be coalesced like the title lookups above
+        results = await asyncio.gather(
+            *(self._fetch_extract(session, title) for title in titles),
+            return_exceptions=True
+        )
+        
+        contents = {}
+        for title, result in zip(titles, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Error downloading {title}: {result}")
+                continue
+            contents[title] = result
+        return contents
+    
+    async def _fetch_extract(self, session: aiohttp.ClientSession, title: str) -> str:
+        """Fetch the plain-text content of a single page"""
+        data = await self._query(session, titles=title, prop="extracts", explaintext=1)
+        return data["query"]["pages"][0].get("extract", "")
+    
     def save_articles(self, articles: List[Dict]):
-        """Save articles to JSON file"""
+        """Save articles to the compressed MessagePack corpus file"""
+        self.save_articles_msgpack(articles)
+    
+    def load_articles(self) -> List[Dict]:
+        """Load articles, falling back to a JSON file from older versions"""
+        if os.path.exists(os.path.join(self.data_path, "wikipedia_articles.msgpack.zst")):
+            return self.load_articles_msgpack()
+        return self.load_articles_json()
+    
+    def save_articles_msgpack(self, articles: List[Dict]):
+        """Save articles to zstd-compressed MessagePack file"""
+        file_path = os.path.join(self.data_path, "wikipedia_articles.msgpack.zst")
+        with open(file_path, 'wb') as f:
+            f.write(zstd.ZstdCompressor(level=3).compress(msgpack.packb(articles, use_bin_type=True)))
+        logger.info(f"Saved {len(articles)} articles to {file_path}")
+    
+    def load_articles_msgpack(self) -> List[Dict]:
+        """Load articles from zstd-compressed MessagePack file"""
+        file_path = os.path.join(self.data_path, "wikipedia_articles.msgpack.zst")
+        if os.path.exists(file_path):
+            with open(file_path, 'rb') as f:
+                articles = msgpack.unpackb(zstd.ZstdDecompressor().decompress(f.read()), raw=False)
+            logger.info(f"Loaded {len(articles)} articles from {file_path}")
+            return articles
+        return []
+    
+    def save_articles_json(self, articles: List[Dict]):
+        """Save articles to JSON file (human-readable export for debugging)"""
         file_path = os.path.join(self.data_path, "wikipedia_articles.json")
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(articles, f, indent=2, ensure_ascii=False)
+        if orjson is not None:
+            with open(file_path, 'wb') as f:
+                f.write(orjson.dumps(articles, option=orjson.OPT_INDENT_2))
+        else:
+            with open(file_path, 'w', encoding='utf-8') as f:
+                json.dump(articles, f, indent=2, ensure_ascii=False)
         logger.info(f"Saved {len(articles)} articles to {file_path}")
     
-    def load_articles(self) -> List[Dict]:
+    def load_articles_json(self) -> List[Dict]:
         """Load articles from JSON file"""
         file_path = os.path.join(self.data_path, "wikipedia_articles.json")
         if os.path.exists(file_path):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                articles = json.load(f)
+            if orjson is not None:
+                with open(file_path, 'rb') as f:
+                    articles = orjson.loads(f.read())
+            else:
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    articles = json.load(f)
             logger.info(f"Loaded {len(articles)} articles from {file_path}")
             return articles
         return []
     
     def chunk_text(self, text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
         """Split text into overlapping chunks"""
-        words = text.split()
+        # Slice the original string between word offsets rather than re-joining word lists
+        starts = []
+        ends = []
+        for match in re.finditer(r"\S+", text):
+            starts.append(match.start())
+            ends.append(match.end())
+        
         chunks = []
         
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk = ' '.join(words[i:i + chunk_size])
-            chunks.append(chunk)
+        for i in range(0, len(starts), chunk_size - overlap):
+            last = min(i + chunk_size, len(starts)) - 1
+            chunks.append(text[starts[i]:ends[last]])
             
-            if i + chunk_size >= len(words):
+            if i + chunk_size >= len(starts):
                 break
         
         return chunks
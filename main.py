@@ -1,19 +1,201 @@
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse
-from pydantic import BaseModel
-from typing import List, Dict
+from fastapi.responses import HTMLResponse, JSONResponse, ORJSONResponse, Response, StreamingResponse
+from fastapi.routing import APIRoute
+from starlette.background import BackgroundTask
+from starlette.concurrency import iterate_in_threadpool
+from pydantic import BaseModel, ValidationError
+from typing import Any, List, Dict, Mapping, Optional, Set, Tuple
+import asyncio
+import brotli
+import gzip
+import hashlib
+import json
 import logging
+import minify_html
+import msgpack
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
 
 # Assuming these are your custom modules
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib codec
+    orjson = None
+
 from rag_system import WikipediaRAGSystem
 from data_loader import WikipediaLoader
-from ui import html_content  # Import the HTML content from ui.py
+from ui import html_content, static_assets, sw_content  # Import the HTML content from ui.py
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# --- Static Assets ---
+def _encoded_variants(body: bytes) -> Dict[str, bytes]:
+    """Precompress a static body for each supported Content-Encoding"""
+    return {
+        "br": brotli.compress(body, quality=11),
+        "gzip": gzip.compress(body, compresslevel=9),
+        "identity": body
+    }
+
+def _etag_matches(request: Request, tag: str) -> bool:
+    """Whether the request's If-None-Match already names this representation"""
+    if_none_match = request.headers.get("if-none-match", "")
+    return if_none_match.strip() == "*" or tag in (t.strip().removeprefix("W/") for t in if_none_match.split(","))
+
+def _accepted_encodings(accept_encoding: str) -> Set[str]:
+    """Content codings an Accept-Encoding header allows, i.e. those not refused with q=0"""
+    accepted, refused = set(), set()
+    wildcard = False
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        
+        if coding == "*":
+            wildcard = q > 0
+        elif q > 0:
+            accepted.add(coding)
+        else:
+            refused.add(coding)
+    
+    # "*" covers every coding the header doesn't name
+    if wildcard:
+        accepted |= {"br", "gzip"} - refused
+    return accepted
+
+def _static_response(request: Request, variants: Dict[str, bytes], etag: str,
+                     media_type: str, cache_control: str) -> Response:
+    """Serve a precompressed static body, answering revalidations with 304"""
+    accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next((coding for coding in ("br", "gzip") if coding in accepted), "identity")
+    
+    # Each encoding is a separate representation, so it gets its own strong ETag
+    tag = f'"{etag}-{encoding}"'
+    headers = {"ETag": tag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    
+    if _etag_matches(request, tag):
+        return Response(status_code=304, headers=headers)
+    
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=variants[encoding], media_type=media_type, headers=headers)
+
+# Minify, encode and compress the static UI page once instead of on every request. minify_js
+# is left off: minify-html 0.15 rewrites '\n' literals as `\\n`, which broke the NDJSON reader
+_ROOT_BYTES = minify_html.minify(html_content, minify_css=True).encode("utf-8")
+_ROOT_VARIANTS = _encoded_variants(_ROOT_BYTES)
+_ROOT_ETAG = hashlib.sha1(_ROOT_BYTES).hexdigest()
+
+def _minify_asset(content: str, media_type: str) -> str:
+    """Minify a standalone stylesheet the same way inline ones are; scripts are served as written"""
+    # minify_html only minifies styles inside a document, so wrap the bare stylesheet in one
+    if media_type != "text/css":
+        return content
+    
+    minified = minify_html.minify(f"<style>{content}</style>", minify_css=True)
+    if not (minified.startswith("<style>") and minified.endswith("</style>")):
+        return content
+    return minified[len("<style>"):-len("</style>")]
+
+def _check_script(content: str, body: str):
+    """Refuse to serve a script whose '\\n' literals were mangled on the way out"""
+    # minify-html's JS minifier once rewrote '\n' as `\\n`, so the NDJSON reader silently
+    # never found a line break
+    if "\\\\n" in body and "\\\\n" not in content:
+        raise RuntimeError("Prepared script turned newline escapes into literal backslashes")
+
+def _prepare_asset(content: str, media_type: str) -> Tuple[Dict[str, bytes], str, str]:
+    """Minify and encode a ui.py asset once into its (variants, ETag, media type) triple"""
+    body = _minify_asset(content, media_type)
+    if media_type == "text/javascript":
+        _check_script(content, body)
+    body = body.encode("utf-8")
+    return _encoded_variants(body), hashlib.sha1(body).hexdigest(), media_type
+
+# Versioned assets from ui.py, keyed by file name
+_STATIC_ASSETS = {
+    name: _prepare_asset(content, media_type)
+    for name, (content, media_type) in static_assets.items()
+}
+
+# The service worker must live at the root to control the whole site, so it isn't versioned
+_SW_ASSET = _prepare_asset(sw_content, "text/javascript")
+
+# --- MessagePack Support ---
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+
+# Whether the request being handled asked for MessagePack, set by MsgPackRoute
+_wants_msgpack: ContextVar[bool] = ContextVar("wants_msgpack", default=False)
+
+# orjson serializes responses in C, without walking the dicts in Python
+DefaultJSONResponse = ORJSONResponse if orjson else JSONResponse
+
+class APIResponse(DefaultJSONResponse):
+    """JSON response that renders straight to MessagePack when the client asked for it"""
+    def __init__(self, content: Any, status_code: int = 200, headers: Optional[Mapping[str, str]] = None,
+                 media_type: Optional[str] = None, background: Optional[BackgroundTask] = None):
+        # FastAPI reads status_code's default from this signature when building the OpenAPI schema.
+        # Negotiated before rendering, so the content is serialized exactly once
+        if _wants_msgpack.get():
+            self.media_type = MSGPACK_MEDIA_TYPE
+        super().__init__(content, status_code=status_code, headers=headers, media_type=media_type, background=background)
+    
+    def render(self, content) -> bytes:
+        if self.media_type == MSGPACK_MEDIA_TYPE:
+            return msgpack.packb(content, use_bin_type=True)
+        return super().render(content)
+
+def _representation() -> str:
+    """Name of the body format negotiated for this request, for per-representation ETags"""
+    return "msgpack" if _wants_msgpack.get() else "json"
+
+class MsgPackRequest(Request):
+    """Request whose MessagePack body is handed to FastAPI as if it were parsed JSON"""
+    async def json(self):
+        if not hasattr(self, "_json"):
+            self._json = msgpack.unpackb(await self.body(), raw=False)
+        return self._json
+
+class MsgPackRoute(APIRoute):
+    """Route that accepts MessagePack bodies and answers in MessagePack when the client asks"""
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        
+        async def route_handler(request: Request) -> Response:
+            if request.headers.get("content-type", "").startswith(MSGPACK_MEDIA_TYPE):
+                # FastAPI only parses bodies it sees as JSON, so relabel the request
+                scope = dict(request.scope)
+                scope["headers"] = [
+                    (key, value) for key, value in scope["headers"] if key != b"content-type"
+                ] + [(b"content-type", b"application/json")]
+                request = MsgPackRequest(scope, request.receive)
+            
+            token = _wants_msgpack.set(MSGPACK_MEDIA_TYPE in request.headers.get("accept", ""))
+            try:
+                response = await handler(request)
+            finally:
+                _wants_msgpack.reset(token)
+            
+            # The body format depends on Accept, so caches must keep the formats apart
+            if isinstance(response, APIResponse) and "vary" not in response.headers:
+                response.headers["Vary"] = "Accept"
+            return response
+        
+        return route_handler
+
 # --- Pydantic Models ---
 class QueryRequest(BaseModel):
     question: str
@@ -22,14 +204,29 @@ class QueryRequest(BaseModel):
 class QueryResponse(BaseModel):
     query: str
     answer: str
+    answer_html: str
     sources: List[Dict]
     retrieved_chunks: int
 
+class BatchQueryRequest(BaseModel):
+    questions: List[str]
+    max_results: int = 5
+
 class IndexRequest(BaseModel):
     topics: List[str]
     max_articles_per_topic: int = 3
 
+class BatchCall(BaseModel):
+    op: str
+    payload: Dict
+
+class BatchRequest(BaseModel):
+    calls: List[BatchCall]
+
 # --- Lifespan Management ---
+# Worker threads for encode + Chroma calls (torch, numpy and SQLite release the GIL)
+WORKER_THREADS = 32
+
 # Global RAG system instance, initialized during lifespan startup
 rag_system = None
 
@@ -41,14 +238,24 @@ async def lifespan(app: FastAPI):
     global rag_system
     logger.info("Starting up Wikipedia RAG Assistant...")
     
+    # Blocking RAG work runs via asyncio.to_thread, which uses the loop's default executor
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=WORKER_THREADS, thread_name_prefix="rag")
+    )
+    
     try:
         # Initialize RAG system on startup
         rag_system = WikipediaRAGSystem()
         logger.info("RAG system initialized successfully")
         
-        # Check for existing data
-        loader = WikipediaLoader()
-        articles = loader.load_articles()
+        # Check for existing data (the loader is shared so its HTTP session is pooled)
+        loader = WikipediaLoader(embedding_model=rag_system.embedding_model)
+        app.state.loader = loader
+        articles = await asyncio.to_thread(loader.load_articles)
+        # Keep only the count, so /status doesn't re-parse the corpus on every hit
+        app.state.article_count = len(articles)
+        # One-off move of chunks stored under pre-content-hash ids
+        await asyncio.to_thread(rag_system.migrate_legacy_chunks, articles)
         
         if articles:
             logger.info(f"Found {len(articles)} existing articles")
@@ -64,20 +271,62 @@ async def lifespan(app: FastAPI):
 
     # --- Shutdown logic would go here ---
     logger.info("Shutting down Wikipedia RAG Assistant...")
+    await app.state.loader.close()
+
 
+def _ndjson_line(event: Dict) -> bytes:
+    """Encode one streamed event as a newline-terminated JSON line"""
+    if orjson:
+        return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(event) + "\n").encode("utf-8")
 
 # --- FastAPI App Initialization ---
 app = FastAPI(
     title="Wikipedia RAG Assistant",
     description="AI Assistant powered by Wikipedia knowledge and RAG",
     version="1.0.0",
-    lifespan=lifespan  # Use the lifespan context manager
+    lifespan=lifespan,  # Use the lifespan context manager
+    default_response_class=APIResponse
 )
+# JSON endpoints also speak MessagePack (Content-Type / Accept: application/msgpack)
+app.router.route_class = MsgPackRoute
 
 # --- API Endpoints ---
 @app.get("/", response_class=HTMLResponse)
-async def root():
-    return html_content
+async def root(request: Request):
+    return _static_response(
+        request,
+        _ROOT_VARIANTS,
+        _ROOT_ETAG,
+        media_type="text/html",
+        cache_control="public, max-age=3600"
+    )
+
+@app.get("/static/{name}")
+async def static_asset(name: str, request: Request):
+    if name not in _STATIC_ASSETS:
+        raise HTTPException(status_code=404, detail="Not found")
+    
+    variants, etag, media_type = _STATIC_ASSETS[name]
+    # Asset names carry a content hash, so a given URL never changes
+    return _static_response(
+        request,
+        variants,
+        etag,
+        media_type=media_type,
+        cache_control="public, max-age=31536000, immutable"
+    )
+
+@app.get("/sw.js")
+async def service_worker(request: Request):
+    variants, etag, media_type = _SW_ASSET
+    return _static_response(
+        request,
+        variants,
+        etag,
+        media_type=media_type,
+        cache_control="no-cache"
+    )
 
 @app.get("/health")
 async def health_check():
@@ -88,8 +337,7 @@ async def index_topics(request: IndexRequest):
     try:
         logger.info(f"Indexing topics: {request.topics}")
         
-        loader = WikipediaLoader()
-        articles = loader.search_and_download(
+        articles = await app.state.loader.search_and_download_async(
             topics=request.topics, 
             max_articles=request.max_articles_per_topic
         )
@@ -97,7 +345,10 @@ async def index_topics(request: IndexRequest):
         if not articles:
             raise HTTPException(status_code=404, detail="No articles found for the given topics")
         
-        rag_system.add_documents(articles)
+        await asyncio.to_thread(rag_system.add_documents, articles)
+        
+        # search_and_download replaced the saved corpus with the new articles
+        app.state.article_count = len(articles)
         
         return {
             "message": "Topics indexed successfully",
@@ -109,6 +360,25 @@ async def index_topics(request: IndexRequest):
         logger.error(f"Error indexing topics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Answers only change when the index does, so browsers may reuse them for a while
+QUERY_CACHE_CONTROL = "private, max-age=600"
+
+def _query_etag(question: str, max_results: int, representation: str) -> str:
+    """Identify an answer by its question, the index version it was built from and its body format"""
+    key = f"{rag_system.index_version if rag_system else 0}:{max_results}:{question}"
+    return f'"{hashlib.sha256(key.encode("utf-8")).hexdigest()}-{representation}"'
+
+@app.get("/query", response_model=QueryResponse)
+async def query_rag_get(http_request: Request, question: str, max_results: int = 5):
+    """Cacheable GET form of /query"""
+    etag = _query_etag(question, max_results, _representation())
+    headers = {"ETag": etag, "Cache-Control": QUERY_CACHE_CONTROL, "Vary": "Accept"}
+    if _etag_matches(http_request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    result = await query_rag(QueryRequest(question=question, max_results=max_results))
+    return APIResponse(result.model_dump(), headers=headers)
+
 @app.post("/query", response_model=QueryResponse)
 async def query_rag(request: QueryRequest):
     if not rag_system:
@@ -117,7 +387,8 @@ async def query_rag(request: QueryRequest):
     try:
         logger.info(f"Processing query: {request.question}")
         
-        result = rag_system.retrieve_and_generate(
+        result = await asyncio.to_thread(
+            rag_system.retrieve_and_generate,
             query=request.question,
             n_results=request.max_results
         )
@@ -128,19 +399,117 @@ async def query_rag(request: QueryRequest):
         logger.error(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/query/stream")
+async def query_rag_stream(request: QueryRequest, http_request: Request):
+    """Stream the answer as NDJSON token events followed by a final sources event"""
+    if not rag_system:
+        raise HTTPException(status_code=503, detail="RAG system is not initialized. The application may be starting or encountered an error.")
+    
+    logger.info(f"Streaming query: {request.question}")
+    return _stream_answer(request, http_request)
+
+@app.get("/query/stream")
+async def query_rag_stream_get(http_request: Request, question: str, max_results: int = 5):
+    """Cacheable GET form of /query/stream"""
+    etag = _query_etag(question, max_results, "ndjson")
+    headers = {"ETag": etag, "Cache-Control": QUERY_CACHE_CONTROL}
+    if _etag_matches(http_request, etag):
+        return Response(status_code=304, headers=headers)
+    
+    if not rag_system:
+        raise HTTPException(status_code=503, detail="RAG system is not initialized. The application may be starting or encountered an error.")
+    
+    logger.info(f"Streaming query: {question}")
+    
+    # Retrieve before streaming, so a failure is a 5xx rather than a cacheable 200 ending in an error event
+    try:
+        search_results = await asyncio.to_thread(rag_system.search_similar_documents, question, max_results)
+    except Exception as e:
+        logger.error(f"Error streaming query: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    response = _stream_answer(QueryRequest(question=question, max_results=max_results), http_request, search_results)
+    response.headers.update(headers)
+    return response
+
+def _stream_answer(request: QueryRequest, http_request: Request,
+                   search_results: Optional[Dict] = None) -> StreamingResponse:
+    """Build the NDJSON answer stream, retrieving first unless search_results are given"""
+    async def events():
+        try:
+            # Retrieval and generation run in a worker thread, one event at a time
+            answer = rag_system.iter_response(request.question, request.max_results, search_results)
+            async for event in iterate_in_threadpool(answer):
+                # Stop generating once the client has gone away (e.g. it aborted for a new question)
+                if await http_request.is_disconnected():
+                    logger.info(f"Client disconnected, stopping query: {request.question}")
+                    return
+                yield _ndjson_line(event)
+        except Exception as e:
+            logger.error(f"Error streaming query: {e}")
+            yield _ndjson_line({"type": "error", "detail": str(e)})
+    
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+@app.post("/batch_query", response_model=List[QueryResponse])
+async def batch_query_rag(request: BatchQueryRequest):
+    if not rag_system:
+        raise HTTPException(status_code=503, detail="RAG system is not initialized. The application may be starting or encountered an error.")
+    
+    if not request.questions:
+        return []
+    
+    try:
+        logger.info(f"Processing {len(request.questions)} batched queries")
+        
+        results = await asyncio.to_thread(
+            rag_system.retrieve_and_generate_batch,
+            queries=request.questions,
+            n_results=request.max_results
+        )
+        
+        return [QueryResponse(**result) for result in results]
+        
+    except Exception as e:
+        logger.error(f"Error processing batched queries: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/batch")
+async def batch(request: BatchRequest):
+    """Run several index/query calls concurrently, returning results in call order"""
+    handlers = {
+        "index": (IndexRequest, index_topics),
+        "query": (QueryRequest, query_rag)
+    }
+    
+    async def run(call: BatchCall) -> Dict:
+        if call.op not in handlers:
+            return {"ok": False, "status": 400, "detail": f"Unknown operation: {call.op}"}
+        
+        model, handler = handlers[call.op]
+        try:
+            result = await handler(model(**call.payload))
+            if isinstance(result, BaseModel):
+                result = result.model_dump()
+            return {"ok": True, "result": result}
+        except ValidationError as e:
+            return {"ok": False, "status": 422, "detail": str(e)}
+        except HTTPException as e:
+            return {"ok": False, "status": e.status_code, "detail": e.detail}
+    
+    return {"results": await asyncio.gather(*(run(call) for call in request.calls))}
+
 @app.get("/status")
 async def get_status():
     if not rag_system:
         return {"status": "initializing", "message": "RAG system not yet available."}
         
     try:
-        loader = WikipediaLoader()
-        articles = loader.load_articles()
         collection_count = rag_system.collection.count()
         
         return {
             "status": "operational",
-            "total_articles": len(articles),
+            "total_articles": app.state.article_count,
             "total_chunks": collection_count,
             "rag_system_initialized": True
         }
@@ -152,4 +521,6 @@ async def get_status():
 # --- Main Execution ---
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Keep idle connections open between the index and query steps of a session
+    # (uvicorn closes them after 5s by default)
+    uvicorn.run(app, host="0.0.0.0", port=8000, timeout_keep_alive=75)
@@ -1,78 +1,216 @@
+import functools
+import html
+import itertools
 import os
-from typing import List, Dict, Tuple
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Dict, Optional, Tuple
 import chromadb
 from sentence_transformers import SentenceTransformer
+from sentence_transformers.util import batch_to_device
 import numpy as np
+import torch
+import xxhash
 from dotenv import load_dotenv
 import logging
 
 load_dotenv()
+# Let the Rust tokenizers use all cores when pre-tokenizing document batches
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
 logger = logging.getLogger(__name__)
 
+# Chunk ids are xxh3-64 hex digests of the chunk text
+CHUNK_ID = re.compile(r"[0-9a-f]{16}")
+
+class EmbeddingCache:
+    """SQLite store of chunk embeddings keyed by the chunk's xxh3-64 hash, one table per model,
+    plus a few bookkeeping values about the vector store"""
+    
+    def __init__(self, path: str, model: str):
+        self.path = path
+        # The cache outlives the collection, so vectors from another model (or
+        # backend / exported graph) must never be served for this one
+        self._table = f"emb_{xxhash.xxh3_64_hexdigest(model)}"
+        # Shared by the worker threads that run add_documents
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS {self._table} (h INTEGER PRIMARY KEY, v BLOB)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+            # Entries written before keys carried the model identity can't be attributed to one
+            self._conn.execute("DROP TABLE IF EXISTS emb")
+    
+    @staticmethod
+    def key(chunk_id: str) -> int:
+        """Convert a hex chunk id to SQLite's signed 64-bit integer range"""
+        h = int(chunk_id, 16)
+        return h - (1 << 64) if h >= (1 << 63) else h
+    
+    def get_many(self, keys: List[int]) -> Dict[int, np.ndarray]:
+        """Return the cached embeddings for whichever keys are present"""
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._conn.execute(f"SELECT h, v FROM {self._table} WHERE h IN ({placeholders})", keys).fetchall()
+        return {h: np.frombuffer(v, dtype=np.float32) for h, v in rows}
+    
+    def put_many(self, keys: List[int], embeddings: np.ndarray):
+        """Store embeddings, leaving existing entries untouched"""
+        rows = [(h, embedding.astype(np.float32, copy=False).tobytes()) for h, embedding in zip(keys, embeddings)]
+        with self._lock, self._conn:
+            self._conn.executemany(f"INSERT OR IGNORE INTO {self._table} (h, v) VALUES (?, ?)", rows)
+    
+    def get_meta(self, key: str) -> Optional[str]:
+        """Return a bookkeeping value, or None if it was never set"""
+        with self._lock:
+            row = self._conn.execute("SELECT v FROM meta WHERE k = ?", (key,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, key: str, value: str):
+        """Store a bookkeeping value"""
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES (?, ?)", (key, value))
+
 class WikipediaRAGSystem:
     def __init__(self, 
                  model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
-                 vector_store_path: str = "./vector_store"):
+                 vector_store_path: str = "./vector_store",
+                 backend: str = os.getenv("EMBEDDING_BACKEND", "torch"),
+                 model_file: Optional[str] = os.getenv("EMBEDDING_MODEL_FILE")):
         
         self.model_name = model_name
         self.vector_store_path = vector_store_path
+        self.backend = backend
+        self.model_file = model_file
         
-        # Initialize embedding model
-        logger.info(f"Loading embedding model: {model_name}")
-        self.embedding_model = SentenceTransformer(model_name)
+        # Initialize embedding model. The "onnx" and "openvino" backends need
+        # optimum[onnxruntime] / optimum[openvino]; model_file selects an exported
+        # graph such as "onnx/model_qint8_avx512_vnni.onnx"
+        logger.info(f"Loading embedding model: {model_name} ({backend} backend)")
+        self.embedding_model = SentenceTransformer(
+            model_name,
+            backend=backend,
+            model_kwargs={"file_name": model_file} if model_file else None
+        )
         
         # Initialize vector store
         os.makedirs(vector_store_path, exist_ok=True)
         self.client = chromadb.PersistentClient(path=vector_store_path)
         
-        # Get or create collection
+        # Get or create collection. Embeddings are L2-normalized at encode time, so
+        # inner product ranks exactly like cosine without the per-query norm work
         self.collection = self.client.get_or_create_collection(
             name="wikipedia_articles",
-            metadata={"hnsw:space": "cosine"}
+            metadata={
+                "hnsw:space": "ip",
+                "hnsw:M": 32,
+                "hnsw:construction_ef": 200,
+                "hnsw:search_ef": 64
+            }
         )
         
-        logger.info("RAG System initialized successfully")
-    
-    def add_documents(self, articles: List[Dict]):
-        """Add Wikipedia articles to vector store"""
-        from data_loader import WikipediaLoader
-        loader = WikipediaLoader()
+        # Persistent chunk embedding cache, so re-indexing skips the encoder
+        self.embedding_cache = EmbeddingCache(
+            os.path.join(vector_store_path, "emb_cache.db"),
+            model=f"{model_name}|{backend}|{model_file or ''}"
+        )
         
-        documents = []
-        metadatas = []
-        ids = []
+        # Cache query embeddings per instance, keyed on the normalized query text
+        self._embed_query = functools.lru_cache(maxsize=1024)(self._encode_query)
         
-        doc_id = 0
+        # Bumped whenever the collection's contents change, so cached answers can be validated
+        self._version_lock = threading.Lock()
+        self.index_version = int(self.embedding_cache.get_meta("index_version") or 0)
         
-        for article in articles:
-            # Chunk the article content
-            chunks = loader.chunk_text(article['content'])
+        logger.info("RAG System initialized successfully")
+    
+    def migrate_legacy_chunks(self, articles: List[Dict], batch_size: int = 100) -> bool:
+        """Move chunks stored under the old "{doc_id}_{chunk_idx}" ids to content-hash ids, once"""
+        if self.embedding_cache.get_meta("chunk_ids") == "xxh3":
+            return False
+        
+        # Those rows hold whitespace-joined text, so re-indexing would add every chunk
+        # again under its content hash and fill the top-k with duplicates
+        legacy = [chunk_id for chunk_id in self.collection.get(include=[])['ids'] if not CHUNK_ID.fullmatch(chunk_id)]
+        if legacy:
+            # Articles in the saved corpus are re-chunked; any others (from earlier /index
+            # runs) keep their stored text and vectors under content-hash ids
+            self.add_documents(articles)
+            rebuilt = {article['title'] for article in articles}
             
-            for chunk_idx, chunk in enumerate(chunks):
-                documents.append(chunk)
-                metadatas.append({
-                    "title": article['title'],
-                    "url": article['url'],
-                    "topic": article['topic'],
-                    "chunk_id": chunk_idx,
-                    "total_chunks": len(chunks)
-                })
-                ids.append(f"{doc_id}_{chunk_idx}")
+            for i in range(0, len(legacy), batch_size):
+                rows = self.collection.get(ids=legacy[i:i + batch_size], include=['documents', 'metadatas', 'embeddings'])
+                kept = {}
+                for document, metadata, embedding in zip(rows['documents'], rows['metadatas'], rows['embeddings']):
+                    if metadata['title'] not in rebuilt:
+                        kept.setdefault(xxhash.xxh3_64_hexdigest(document), (document, metadata, embedding))
+                
+                existing = set(self.collection.get(ids=list(kept), include=[])['ids']) if kept else set()
+                kept = {chunk_id: row for chunk_id, row in kept.items() if chunk_id not in existing}
+                if kept:
+                    self.collection.add(
+                        ids=list(kept),
+                        documents=[document for document, _, _ in kept.values()],
+                        metadatas=[metadata for _, metadata, _ in kept.values()],
+                        embeddings=[list(embedding) for _, _, embedding in kept.values()]
+                    )
+                self.collection.delete(ids=rows['ids'])
             
-            doc_id += 1
+            logger.info(f"Moved {len(legacy)} chunks off legacy ids ({len(rebuilt)} articles re-chunked)")
+            self._bump_index_version()
+        
+        self.embedding_cache.set_meta("chunk_ids", "xxh3")
+        return bool(legacy)
+    
+    def add_documents(self, articles: List[Dict], batch_size: int = 100):
+        """Add Wikipedia articles to vector store"""
+        logger.info(f"Adding {len(articles)} articles to vector store...")
         
-        # Generate embeddings and add to collection
-        logger.info(f"Adding {len(documents)} document chunks to vector store...")
+        # Pull chunks lazily so only one batch is held in memory at a time
+        chunks = self._iter_chunks(articles)
+        total = 0
+        skipped = 0
+        cache_hits = 0
         
-        # Process in batches to avoid memory issues
-        batch_size = 100
-        for i in range(0, len(documents), batch_size):
-            batch_docs = documents[i:i+batch_size]
-            batch_metadatas = metadatas[i:i+batch_size]
-            batch_ids = ids[i:i+batch_size]
+        while True:
+            batch = list(itertools.islice(chunks, batch_size))
+            if not batch:
+                break
             
-            # Generate embeddings
-            embeddings = self.embedding_model.encode(batch_docs).tolist()
+            # Skip chunks that are already stored or repeated within this batch
+            existing = set(self.collection.get(ids=[chunk_id for chunk_id, _, _ in batch], include=[])['ids'])
+            new_chunks = []
+            for item in batch:
+                if item[0] in existing:
+                    continue
+                existing.add(item[0])
+                new_chunks.append(item)
+            
+            skipped += len(batch) - len(new_chunks)
+            batch = new_chunks
+            if not batch:
+                continue
+            
+            batch_ids = [chunk_id for chunk_id, _, _ in batch]
+            batch_docs = [doc for _, doc, _ in batch]
+            batch_metadatas = [metadata for _, _, metadata in batch]
+            
+            # Generate embeddings for cache misses only
+            keys = [EmbeddingCache.key(chunk_id) for chunk_id in batch_ids]
+            cached = self.embedding_cache.get_many(keys)
+            missing = [i for i, key in enumerate(keys) if key not in cached]
+            if missing:
+                fresh = self._encode_documents([batch_docs[i] for i in missing])
+                missing_keys = [keys[i] for i in missing]
+                self.embedding_cache.put_many(missing_keys, fresh)
+                cached.update(zip(missing_keys, fresh))
+            cache_hits += len(keys) - len(missing)
+            
+            # chromadb 0.4 only accepts embeddings as lists
+            embeddings = np.stack([cached[key] for key in keys]).tolist()
             
             # Add to collection
             self.collection.add(
@@ -81,17 +219,93 @@ class WikipediaRAGSystem:
                 embeddings=embeddings,
                 ids=batch_ids
             )
+            total += len(batch)
         
-        logger.info(f"Successfully added {len(documents)} chunks to vector store")
+        logger.info(
+            f"Successfully added {total} chunks to vector store "
+            f"({skipped} already present, {cache_hits} embeddings from cache)"
+        )
+        if total:
+            self._bump_index_version()
+    
+    def _bump_index_version(self):
+        """Record that the collection changed, persisting the new version"""
+        with self._version_lock:
+            self.index_version += 1
+            self.embedding_cache.set_meta("index_version", str(self.index_version))
+    
+    def _encode_documents(self, docs: List[str], batch_size: int = 64) -> np.ndarray:
+        """Encode chunks, tokenizing the next batch on a worker thread while the model runs"""
+        batches = [docs[i:i + batch_size] for i in range(0, len(docs), batch_size)]
+        embeddings = []
+        
+        with ThreadPoolExecutor(max_workers=1) as tokenizer:
+            pending = tokenizer.submit(self.embedding_model.tokenize, batches[0])
+            
+            for i in range(len(batches)):
+                features = pending.result()
+                if i + 1 < len(batches):
+                    pending = tokenizer.submit(self.embedding_model.tokenize, batches[i + 1])
+                
+                features = batch_to_device(features, self.embedding_model.device)
+                with torch.inference_mode():
+                    output = self.embedding_model.forward(features)["sentence_embedding"]
+                embeddings.append(torch.nn.functional.normalize(output, p=2, dim=1).cpu().numpy())
+        
+        return np.concatenate(embeddings)
+    
+    def _iter_chunks(self, articles: List[Dict]) -> Iterator[Tuple[str, str, Dict]]:
+        """Yield (id, chunk, metadata) for every chunk of every article"""
+        from data_loader import WikipediaLoader
+        loader = WikipediaLoader()
+        
+        for article in articles:
+            # Chunk the article content
+            chunks = loader.chunk_text(article['content'])
+            
+            for chunk_idx, chunk in enumerate(chunks):
+                # Content-hash ids make re-indexing idempotent
+                yield xxhash.xxh3_64_hexdigest(chunk), chunk, {
+                    "title": article['title'],
+                    "url": article['url'],
+                    "topic": article['topic'],
+                    "chunk_id": chunk_idx,
+                    "total_chunks": len(chunks)
+                }
+    
+    def _encode_query(self, query: str) -> bytes:
+        """Encode a single query to float32 bytes (wrapped by the _embed_query cache)"""
+        return self.embedding_model.encode(
+            query,
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).astype(np.float32, copy=False).tobytes()
     
     def search_similar_documents(self, query: str, n_results: int = 5) -> Dict:
         """Search for similar documents using vector similarity"""
-        # Generate query embedding
-        query_embedding = self.embedding_model.encode([query]).tolist()
+        # Generate query embedding (cached for repeated queries)
+        query_embedding = np.frombuffer(self._embed_query(" ".join(query.split())), dtype=np.float32)
         
         # Search in vector store
         results = self.collection.query(
-            query_embeddings=query_embedding,
+            query_embeddings=[query_embedding.tolist()],
+            n_results=n_results,
+            include=['documents', 'metadatas', 'distances']
+        )
+        
+        return results
+    
+    def search_similar_documents_batch(self, queries: List[str], n_results: int = 5) -> Dict:
+        """Search for several queries at once, encoding them in a single batch"""
+        query_embeddings = self.embedding_model.encode(
+            queries,
+            batch_size=len(queries),
+            convert_to_numpy=True,
+            normalize_embeddings=True
+        ).tolist()
+        
+        results = self.collection.query(
+            query_embeddings=query_embeddings,
             n_results=n_results,
             include=['documents', 'metadatas', 'distances']
         )
@@ -100,18 +314,22 @@ class WikipediaRAGSystem:
     
     def generate_answer(self, query: str, context_docs: List[str]) -> str:
         """Generate answer using retrieved context (simple concatenation for now)"""
+        return "".join(self.iter_answer(query, context_docs))
+    
+    def iter_answer(self, query: str, context_docs: List[str]) -> Iterator[str]:
+        """Yield the answer in pieces as it is produced"""
         # Combine context documents
         context = "\n\n".join(context_docs[:3])  # Use top 3 docs
         
-        # Simple template-based answer (you can replace with LLM later)
-        answer = f"""Based on the Wikipedia articles, here's what I found about your query: "{query}"
+        # Simple template-based answer (you can replace with a streaming LLM later)
+        yield f"""Based on the Wikipedia articles, here's what I found about your query: "{query}"
 
 Context from Wikipedia:
-{context[:1500]}...
+"""
+        yield from context[:1500].splitlines(keepends=True)
+        yield """...
 
 This information comes from Wikipedia articles. For more detailed information, please refer to the original sources."""
-
-        return answer
     
     def retrieve_and_generate(self, query: str, n_results: int = 5) -> Dict:
         """Complete RAG pipeline: retrieve and generate"""
@@ -119,33 +337,74 @@ This information comes from Wikipedia articles. For more detailed information, p
         search_results = self.search_similar_documents(query, n_results)
         
         # Step 2: Extract documents and metadata
+        return self._generate_response(
+            query,
+            search_results['documents'][0],
+            search_results['metadatas'][0],
+            search_results['distances'][0]
+        )
+    
+    def iter_response(self, query: str, n_results: int = 5, search_results: Optional[Dict] = None) -> Iterator[Dict]:
+        """Streaming RAG pipeline: yield answer tokens, then the sources"""
+        # Callers may retrieve up front so retrieval errors surface before anything is streamed
+        if search_results is None:
+            search_results = self.search_similar_documents(query, n_results)
         documents = search_results['documents'][0]
-        metadatas = search_results['metadatas'][0]
-        distances = search_results['distances'][0]
         
+        for text in self.iter_answer(query, documents):
+            yield {"type": "token", "text": text}
+        
+        yield {
+            "type": "done",
+            "sources": self._build_sources(search_results['metadatas'][0], search_results['distances'][0]),
+            "retrieved_chunks": len(documents)
+        }
+    
+    def retrieve_and_generate_batch(self, queries: List[str], n_results: int = 5) -> List[Dict]:
+        """Run the RAG pipeline for several queries with one batched retrieval"""
+        search_results = self.search_similar_documents_batch(queries, n_results)
+        
+        return [
+            self._generate_response(query, documents, metadatas, distances)
+            for query, documents, metadatas, distances in zip(
+                queries,
+                search_results['documents'],
+                search_results['metadatas'],
+                search_results['distances']
+            )
+        ]
+    
+    def _generate_response(self, query: str, documents: List[str],
+                           metadatas: List[Dict], distances: List[float]) -> Dict:
+        """Build the answer and its sources from retrieved chunks"""
         # Step 3: Generate answer
         answer = self.generate_answer(query, documents)
         
         # Step 4: Prepare sources
-        sources = []
-        seen_titles = set()
-        
-        for meta, distance in zip(metadatas, distances):
-            if meta['title'] not in seen_titles:
-                sources.append({
-                    "title": meta['title'],
-                    "url": meta['url'],
-                    "topic": meta['topic'],
-                    "relevance_score": 1 - distance  # Convert distance to similarity
-                })
-                seen_titles.add(meta['title'])
-        
         return {
             "query": query,
             "answer": answer,
-            "sources": sources[:3],  # Top 3 unique sources
+            # Escaped once here so clients can insert it without their own pass
+            "answer_html": html.escape(answer).replace("\n", "<br>"),
+            "sources": self._build_sources(metadatas, distances),
             "retrieved_chunks": len(documents)
         }
+    
+    def _build_sources(self, metadatas: List[Dict], distances: List[float]) -> List[Dict]:
+        """Return the top unique sources, each from its best-ranked chunk"""
+        titles = np.array([meta['title'] for meta in metadatas])
+        _, first_idx = np.unique(titles, return_index=True)
+        first_idx.sort()
+        
+        return [
+            {
+                "title": metadatas[i]['title'],
+                "url": metadatas[i]['url'],
+                "topic": metadatas[i]['topic'],
+                "relevance_score": 1 - distances[i]  # Convert distance to similarity
+            }
+            for i in first_idx[:3]  # Top 3 unique sources
+        ]
 
 # Test the RAG system
 if __name__ == "__main__":
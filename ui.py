@@ -1,17 +1,326 @@
-html_content = r"""
+import hashlib
+
+css_content = """
+    input, textarea, button { width: 100%; padding: 10px; margin: 5px 0; border: 1px solid #ccc; border-radius: 4px; }
+    button { background-color: #4CAF50; color: white; border: none; cursor: pointer; }
+    button:hover { background-color: #45a049; }
+    .result { background-color: #f9f9f9; padding: 15px; border-radius: 4px; margin: 10px 0; }
+    .sources { background-color: #e8f4f8; padding: 10px; border-radius: 4px; margin: 10px 0; }
+    .skeleton { min-height: 60px; color: #888; animation: pulse 1.5s ease-in-out infinite; }
+    @keyframes pulse { 50% { opacity: 0.5; } }
+"""
+
+# Content-hashed file name, so the stylesheet can be cached as immutable
+css_name = f"ui.{hashlib.sha1(css_content.encode('utf-8')).hexdigest()[:12]}.css"
+
+js_content = r"""
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/sw.js');
+    }
+    
+    // Element references, looked up once when the document is ready
+    const els = {};
+    
+    document.addEventListener('DOMContentLoaded', () => {
+        for (const id of ['topics', 'indexBtn', 'indexResult', 'question', 'askBtn', 'clearCacheBtn', 'queryResult']) {
+            els[id] = document.getElementById(id);
+        }
+        // One reusable status node per result area
+        els.indexMessage = createResultNode();
+        els.queryMessage = createResultNode();
+        els.querySkeleton = createResultNode();
+        els.querySkeleton.classList.add('skeleton');
+        
+        els.indexBtn.addEventListener('click', indexTopics);
+        els.askBtn.addEventListener('click', askQuestion);
+        els.clearCacheBtn.addEventListener('click', clearAnswerCache);
+    });
+    
+    function createResultNode() {
+        const node = document.createElement('div');
+        node.className = 'result';
+        return node;
+    }
+    
+    function showMessage(container, node, text) {
+        node.textContent = text;
+        if (container.childNodes.length !== 1 || container.firstChild !== node) {
+            container.replaceChildren(node);
+        }
+    }
+    
+    async function clearAnswerCache() {
+        // The HTTP cache can't be purged from script, so revalidate answers it may still hold
+        _answersInvalidatedAt = Date.now();
+        await dropCachedAnswers();
+        showMessage(els.queryResult, els.queryMessage, 'Cached answers cleared.');
+    }
+    
+    async function dropCachedAnswers() {
+        if ('caches' in window) {
+            await caches.delete('answers-v1');
+        }
+    }
+    
+    // Shared across requests so the click path only allocates the body itself
+    const JSON_HEADERS = Object.freeze({ 'Content-Type': 'application/json' });
+    const encoder = new TextEncoder();
+    
+    // Calls made in the same task are coalesced into a single /batch request
+    const _pending = [];
+    let _flushQueued = false;
+    
+    function rpc(op, payload) {
+        return new Promise((resolve, reject) => {
+            _pending.push({ op, payload, resolve, reject });
+            if (!_flushQueued) {
+                _flushQueued = true;
+                queueMicrotask(flush);
+            }
+        });
+    }
+    
+    async function flush() {
+        const calls = _pending.splice(0);
+        _flushQueued = false;
+        
+        try {
+            const response = await fetch('/batch', {
+                method: 'POST',
+                headers: JSON_HEADERS,
+                body: encoder.encode(JSON.stringify({ calls: calls.map(call => ({ op: call.op, payload: call.payload })) }))
+            });
+            
+            if (!response.ok) {
+                const error = await response.json();
+                throw new Error(error.detail || 'Batch request failed');
+            }
+            
+            const { results } = await response.json();
+            results.forEach((result, i) => {
+                if (result.ok) {
+                    calls[i].resolve(result.result);
+                } else {
+                    calls[i].reject(new Error(result.detail || 'Request failed'));
+                }
+            });
+        } catch (error) {
+            calls.forEach(call => call.reject(error));
+        }
+    }
+    
+    // Index requests keyed by their normalized topic list, so repeat submissions share one
+    const _inflightIndex = new Map();
+    
+    // The index currently being built, which questions asked meanwhile wait for
+    let _indexPromise = null;
+    // Answers the browser cached before this time may be stale (new index or cleared cache)
+    let _answersInvalidatedAt = -Infinity;
+    const ANSWER_MAX_AGE_MS = 600000;
+    
+    async function indexTopics() {
+        // One scan yields the trimmed, non-empty comma-separated topics
+        const topics = els.topics.value.match(/[^,\s](?:[^,]*[^,\s])?/g) || [];
+        
+        if (topics.length === 0) {
+            showMessage(els.indexResult, els.indexMessage, 'Please enter at least one topic.');
+            return;
+        }
+        
+        showMessage(els.indexResult, els.indexMessage, 'Indexing topics... This may take a while.');
+        
+        const key = topics.map(t => t.toLowerCase()).sort().join('|');
+        let request = _inflightIndex.get(key);
+        if (!request) {
+            request = rpc('index', { topics: topics, max_articles_per_topic: 3 });
+            _inflightIndex.set(key, request);
+            // Remember successes for a minute; let failures be retried right away
+            request.then(
+                () => setTimeout(() => _inflightIndex.delete(key), 60000),
+                () => _inflightIndex.delete(key)
+            );
+        }
+        
+        const indexing = request.then(async (result) => {
+            _answersInvalidatedAt = Date.now();
+            await dropCachedAnswers();
+            return result;
+        });
+        _indexPromise = indexing;
+        
+        els.indexBtn.disabled = true;
+        try {
+            const result = await indexing;
+            showMessage(els.indexResult, els.indexMessage, `Successfully indexed ${result.total_articles} articles for ${result.topics.length} topics!`);
+        } catch (error) {
+            showMessage(els.indexResult, els.indexMessage, `Error: ${error.message}`);
+        } finally {
+            if (_indexPromise === indexing) {
+                _indexPromise = null;
+            }
+            els.indexBtn.disabled = false;
+        }
+    }
+    
+    // Controller for the in-flight answer stream, aborted when a new question is asked
+    let _queryController = null;
+    
+    async function askQuestion() {
+        const question = els.question.value;
+        
+        if (!question.trim()) {
+            showMessage(els.queryResult, els.queryMessage, 'Please enter a question.');
+            return;
+        }
+        
+        // Hold the answer slot with a placeholder until the stream starts
+        const indexPromise = _indexPromise || Promise.resolve();
+        showMessage(els.queryResult, els.querySkeleton,
+            _indexPromise ? 'Waiting for indexing to finish...' : 'Searching for answer...');
+        
+        _queryController?.abort();
+        const controller = new AbortController();
+        _queryController = controller;
+        
+        try {
+            // The question can be asked while indexing runs; it is sent as soon as the index is ready
+            const queryPromise = indexPromise.then(() => {
+                if (_queryController === controller) {
+                    els.querySkeleton.textContent = 'Searching for answer...';
+                }
+                // A GET, so repeat questions are answered from the browser's HTTP cache,
+                // revalidated while cached copies may still predate the latest index
+                return fetch(`/query/stream?${new URLSearchParams({ question: question })}`, {
+                    signal: controller.signal,
+                    cache: Date.now() - _answersInvalidatedAt < ANSWER_MAX_AGE_MS ? 'no-cache' : 'default'
+                });
+            });
+            const [, response] = await Promise.all([indexPromise, queryPromise]);
+            
+            if (!response.ok) {
+                const error = await response.json();
+                throw new Error(error.detail || 'Failed to get answer');
+            }
+            
+            // Build the answer node once and append tokens to it as they arrive
+            const result = createResultNode();
+            const heading = document.createElement('h4');
+            heading.textContent = 'Answer:';
+            const answerEl = document.createElement('p');
+            result.append(heading, answerEl);
+            els.queryResult.replaceChildren(result);
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            for (;;) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                
+                let newline;
+                while ((newline = buffer.indexOf('\n')) >= 0) {
+                    const message = JSON.parse(buffer.slice(0, newline));
+                    buffer = buffer.slice(newline + 1);
+                    
+                    if (message.type === 'token') {
+                        appendText(answerEl, message.text);
+                    } else if (message.type === 'done') {
+                        if (message.sources && message.sources.length > 0) {
+                            deferSources(result, message.sources);
+                        }
+                    } else if (message.type === 'error') {
+                        throw new Error(message.detail);
+                    }
+                }
+            }
+        } catch (error) {
+            // A newer question took over the result area
+            if (error.name === 'AbortError') {
+                return;
+            }
+            showMessage(els.queryResult, els.queryMessage, `Error: ${error.message}`);
+        } finally {
+            if (_queryController === controller) {
+                _queryController = null;
+            }
+        }
+    }
+    
+    // Append text with line breaks as <br>, without going through the HTML parser
+    function appendText(node, text) {
+        text.split('\n').forEach((line, i) => {
+            if (i > 0) {
+                node.appendChild(document.createElement('br'));
+            }
+            if (line) {
+                node.appendChild(document.createTextNode(line));
+            }
+        });
+    }
+    
+    // Reserve the sources panel now but only build its list once it scrolls into view
+    function deferSources(container, sources) {
+        const sourcesDiv = document.createElement('div');
+        sourcesDiv.className = 'sources';
+        sourcesDiv.dataset.pending = '1';
+        container.appendChild(sourcesDiv);
+        
+        if (!('IntersectionObserver' in window)) {
+            renderSources(sourcesDiv, sources);
+            return;
+        }
+        
+        new IntersectionObserver((entries, observer) => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                observer.disconnect();
+                renderSources(sourcesDiv, sources);
+            }
+        }).observe(sourcesDiv);
+    }
+    
+    function renderSources(sourcesDiv, sources) {
+        // Build the list off-document and attach it once; textContent keeps titles inert
+        const heading = document.createElement('h4');
+        heading.textContent = 'Sources:';
+        const list = document.createElement('ul');
+        const fragment = document.createDocumentFragment();
+        for (const source of sources) {
+            const item = document.createElement('li');
+            const link = document.createElement('a');
+            link.href = source.url;
+            link.target = '_blank';
+            link.rel = 'noopener';
+            link.textContent = source.title;
+            item.append(link, ` (Topic: ${source.topic})`);
+            fragment.appendChild(item);
+        }
+        list.appendChild(fragment);
+        sourcesDiv.append(heading, list);
+        delete sourcesDiv.dataset.pending;
+    }
+"""
+
+js_name = f"ui.{hashlib.sha1(js_content.encode('utf-8')).hexdigest()[:12]}.js"
+
+# Files served under /static/: name -> (content, media type)
+static_assets = {
+    css_name: (css_content, "text/css"),
+    js_name: (js_content, "text/javascript")
+}
+
+# Rendered once at import; only the asset names vary between builds
+html_template = """
     <!DOCTYPE html>
     <html>
     <head>
         <title>Wikipedia RAG Assistant</title>
         <style>
-            body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
-            .container { margin: 20px 0; }
-            input, textarea, button { width: 100%; padding: 10px; margin: 5px 0; border: 1px solid #ccc; border-radius: 4px; }
-            button { background-color: #4CAF50; color: white; border: none; cursor: pointer; }
-            button:hover { background-color: #45a049; }
-            .result { background-color: #f9f9f9; padding: 15px; border-radius: 4px; margin: 10px 0; }
-            .sources { background-color: #e8f4f8; padding: 10px; border-radius: 4px; margin: 10px 0; }
+            body {{ font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }}
+            .container {{ margin: 20px 0; }}
         </style>
+        <link rel="stylesheet" href="/static/{css_name}">
+        <script src="/static/{js_name}" defer></script>
     </head>
     <body>
         <h1>🤖 Wikipedia RAG Assistant</h1>
@@ -20,93 +329,79 @@ html_content = r"""
         <div class="container">
             <h3>1. First, Index Some Topics:</h3>
             <input type="text" id="topics" placeholder="Enter topics separated by commas (e.g., Python, Machine Learning, AI)" />
-            <button onclick="indexTopics()">Index Topics</button>
+            <button id="indexBtn">Index Topics</button>
             <div id="indexResult"></div>
         </div>
         
         <div class="container">
             <h3>2. Ask Questions:</h3>
             <textarea id="question" placeholder="Ask your question here..." rows="3"></textarea>
-            <button onclick="askQuestion()">Ask Question</button>
+            <button id="askBtn">Ask Question</button>
+            <button id="clearCacheBtn">Clear Cached Answers</button>
             <div id="queryResult"></div>
         </div>
-        <script>
-            async function indexTopics() {
-                const topics = document.getElementById('topics').value.split(',').map(t => t.trim());
-                const resultDiv = document.getElementById('indexResult');
-                
-                if (topics.length === 0 || topics[0] === '') {
-                    resultDiv.innerHTML = '<div class="result">Please enter at least one topic.</div>';
-                    return;
-                }
-                
-                resultDiv.innerHTML = '<div class="result">Indexing topics... This may take a while.</div>';
-                
-                try {
-                    const response = await fetch('/index', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ topics: topics, max_articles_per_topic: 3 })
-                    });
-                    
-                    if (!response.ok) {
-                        const error = await response.json();
-                        throw new Error(error.detail || 'Failed to index topics');
-                    }
-                    
-                    const result = await response.json();
-                    resultDiv.innerHTML = `<div class="result">Successfully indexed ${result.total_articles} articles for ${result.topics.length} topics!</div>`;
-                } catch (error) {
-                    resultDiv.innerHTML = `<div class="result">Error: ${error.message}</div>`;
-                }
-            }
-            
-            async function askQuestion() {
-                const question = document.getElementById('question').value;
-                const resultDiv = document.getElementById('queryResult');
-                
-                if (!question.trim()) {
-                    resultDiv.innerHTML = '<div class="result">Please enter a question.</div>';
-                    return;
-                }
-                
-                resultDiv.innerHTML = '<div class="result">Searching for answer...</div>';
-                
-                try {
-                    const response = await fetch('/query', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ question: question })
-                    });
-                    
-                    if (!response.ok) {
-                        const error = await response.json();
-                        throw new Error(error.detail || 'Failed to get answer');
-                    }
-                    
-                    const result = await response.json();
-                    
-                    let sourcesHtml = '';
-                    if (result.sources && result.sources.length > 0) {
-                        sourcesHtml = '<div class="sources"><h4>Sources:</h4><ul>';
-                        result.sources.forEach(source => {
-                            sourcesHtml += `<li><a href="${source.url}" target="_blank">${source.title}</a> (Topic: ${source.topic})</li>`;
-                        });
-                        sourcesHtml += '</ul></div>';
-                    }
-                    
-                    resultDiv.innerHTML = `
-                        <div class="result">
-                            <h4>Answer:</h4>
-                            <p>${result.answer.replace(/\\n/g, '<br>')}</p>
-                            ${sourcesHtml}
-                        </div>
-                    `;
-                } catch (error) {
-                    resultDiv.innerHTML = `<div class="result">Error: ${error.message}</div>`;
-                }
-            }
-        </script>
     </body>
     </html>
-"""
\ No newline at end of file
+"""
+
+html_content = html_template.format_map({"css_name": css_name, "js_name": js_name})
+
+sw_content = """
+    const SHELL_CACHE = 'shell-__SHELL_VERSION__';
+    const ANSWER_CACHE = 'answers-v1';
+    const SHELL_URLS = ['/', '/static/__CSS_NAME__', '/static/__JS_NAME__'];
+    
+    self.addEventListener('install', event => {
+        event.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.addAll(SHELL_URLS)));
+        self.skipWaiting();
+    });
+    
+    self.addEventListener('activate', event => {
+        // Drop shells cached by previous versions of the page
+        event.waitUntil(
+            caches.keys()
+                .then(keys => Promise.all(
+                    keys.filter(key => key.startsWith('shell-') && key !== SHELL_CACHE)
+                        .map(key => caches.delete(key))
+                ))
+                .then(() => self.clients.claim())
+        );
+    });
+    
+    self.addEventListener('fetch', event => {
+        const url = new URL(event.request.url);
+        if (url.origin !== self.location.origin) {
+            return;
+        }
+        
+        if (event.request.method !== 'GET') {
+            return;
+        }
+        
+        if (SHELL_URLS.includes(url.pathname)) {
+            event.respondWith(staleWhileRevalidate(event, SHELL_CACHE, event.request));
+        } else if (url.pathname === '/query/stream') {
+            event.respondWith(staleWhileRevalidate(event, ANSWER_CACHE, event.request));
+        }
+    });
+    
+    // Serve the cached copy immediately and refresh it in the background
+    async function staleWhileRevalidate(event, cacheName, key) {
+        const cache = await caches.open(cacheName);
+        const cached = await cache.match(key);
+        const refresh = fetch(event.request).then(response => {
+            if (response.ok) {
+                cache.put(key, response.clone());
+            }
+            return response;
+        });
+        
+        if (cached) {
+            event.waitUntil(refresh.catch(() => {}));
+            return cached;
+        }
+        return refresh;
+    }
+""".replace("__CSS_NAME__", css_name).replace("__JS_NAME__", js_name).replace(
+    "__SHELL_VERSION__", hashlib.sha1(html_content.encode("utf-8")).hexdigest()[:12]
+)